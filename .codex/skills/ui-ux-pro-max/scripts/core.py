@@ -5,10 +5,13 @@ UI/UX Pro Max Core - BM25 search engine for UI/UX style guides
 """
 
 import csv
+import heapq
 import re
+from bisect import bisect_left
 from pathlib import Path
 from math import log
-from collections import defaultdict
+from collections import Counter
+from functools import lru_cache
 
 # ============ CONFIGURATION ============
 DATA_DIR = Path(__file__).parent.parent / "data"
@@ -80,23 +83,40 @@ AVAILABLE_STACKS = list(STACK_CONFIG.keys())
 
 
 # ============ BM25 IMPLEMENTATION ============
+def _score_kernel(query_postings, n_docs, k):
+    """Sum weighted (doc_ids, contribs, weight) postings into dense scores and
+    return the top k (doc_idx, score) pairs; ties keep the lower doc index first"""
+    scores = [0.0] * n_docs
+    for doc_ids, contribs, weight in query_postings:
+        for idx, contrib in zip(doc_ids, contribs):
+            scores[idx] += contrib * weight
+    return heapq.nlargest(k, enumerate(scores), key=lambda x: x[1])
+
+
 class BM25:
     """BM25 ranking algorithm for text search"""
 
+    # Runs of 3+ word characters: punctuation split and short-word filter in one pass
+    _TOKEN_RE = re.compile(r'\w{3,}')
+
     def __init__(self, k1=1.5, b=0.75):
         self.k1 = k1
         self.b = b
         self.corpus = []
         self.doc_lengths = []
+        self.len_norm = []
+        self.vocab = {}
+        self.sorted_vocab = []
+        self.postings = []
+        self.precomputed = []
         self.avgdl = 0
-        self.idf = {}
-        self.doc_freqs = defaultdict(int)
+        self.idf = []
+        self.doc_freqs = Counter()
         self.N = 0
 
     def tokenize(self, text):
         """Lowercase, split, remove punctuation, filter short words"""
-        text = re.sub(r'[^\w\s]', ' ', str(text).lower())
-        return [w for w in text.split() if len(w) > 2]
+        return self._TOKEN_RE.findall(str(text).lower())
 
     def fit(self, documents):
         """Build BM25 index from documents"""
@@ -106,90 +126,177 @@ class BM25:
             return
         self.doc_lengths = [len(doc) for doc in self.corpus]
         self.avgdl = sum(self.doc_lengths) / self.N
+        if self.avgdl == 0:
+            return
+        # Loop invariants hoisted; evaluation order matches the textbook formula
+        k1, b, avgdl = self.k1, self.b, self.avgdl
+        k1p1, one_minus_b = k1 + 1, 1 - b
+        self.len_norm = [k1 * (one_minus_b + b * dl / avgdl) for dl in self.doc_lengths]
 
-        for doc in self.corpus:
-            seen = set()
-            for word in doc:
-                if word not in seen:
-                    self.doc_freqs[word] += 1
-                    seen.add(word)
+        # Tokens are interned to ids; per-token tables below are lists indexed by id
+        # Inverted index: id -> (doc_ids, term_freqs), stored as parallel lists
+        for idx, doc in enumerate(self.corpus):
+            for word, tf in Counter(doc).items():
+                tid = self.vocab.setdefault(word, len(self.vocab))
+                if tid == len(self.postings):
+                    self.postings.append(([], []))
+                doc_ids, tfs = self.postings[tid]
+                doc_ids.append(idx)
+                tfs.append(tf)
 
-        for word, freq in self.doc_freqs.items():
-            self.idf[word] = log((self.N - freq + 0.5) / (freq + 0.5) + 1)
+        for doc in self.corpus:
+            self.doc_freqs.update(set(doc))
 
-    def score(self, query):
-        """Score all documents against query"""
-        query_tokens = self.tokenize(query)
-        scores = []
+        N = self.N
+        self.idf = [log((N - freq + 0.5) / (freq + 0.5) + 1) for freq in map(self.doc_freqs.__getitem__, self.vocab)]
 
-        for idx, doc in enumerate(self.corpus):
-            score = 0
-            doc_len = self.doc_lengths[idx]
-            term_freqs = defaultdict(int)
-            for word in doc:
-                term_freqs[word] += 1
+        # Per-(token, doc) BM25 contribution, aligned with postings doc_ids
+        len_norm = self.len_norm
+        for idf, (doc_ids, tfs) in zip(self.idf, self.postings):
+            contribs = [
+                idf * (tf * k1p1) / (tf + len_norm[idx])
+                for idx, tf in zip(doc_ids, tfs)
+            ]
+            self.precomputed.append(contribs)
 
-            for token in query_tokens:
-                if token in self.idf:
-                    tf = term_freqs[token]
-                    idf = self.idf[token]
-                    numerator = tf * (self.k1 + 1)
-                    denominator = tf + self.k1 * (1 - self.b + self.b * doc_len / self.avgdl)
-                    score += idf * numerator / denominator
+        # Term frequencies are folded into the weights; keep only the doc ids
+        self.postings = [doc_ids for doc_ids, _ in self.postings]
 
-            scores.append((idx, score))
+        # Sorted vocabulary doubles as a prefix index: all tokens sharing a
+        # prefix form one contiguous run, found by bisection
+        self.sorted_vocab = sorted(self.vocab)
 
-        return sorted(scores, key=lambda x: x[1], reverse=True)
+        # Token lists and document frequencies are only needed while fitting
+        self.corpus = []
+        self.doc_freqs = Counter()
+
+    def _token_terms(self, token):
+        """Map one query token to (token_id, weight) terms. Exact match weighs 1;
+        prefix expansions ("minimal" -> "minimalism") share 1 / (1 + count)"""
+        sorted_vocab = self.sorted_vocab
+        pos = bisect_left(sorted_vocab, token)
+        expanded = []
+        while pos < len(sorted_vocab) and sorted_vocab[pos].startswith(token):
+            if sorted_vocab[pos] != token:
+                expanded.append(self.vocab[sorted_vocab[pos]])
+            pos += 1
+        terms = [(self.vocab[token], 1.0)] if token in self.vocab else []
+        weight = 1.0 / (1 + len(expanded))
+        terms.extend((tid, weight) for tid in expanded)
+        return terms
+
+    def _query_terms(self, query, memo=None):
+        """Concatenate the terms of every query token, reusing memo across calls"""
+        if memo is None:
+            memo = {}
+        terms = []
+        for token in self.tokenize(query):
+            if token not in memo:
+                memo[token] = self._token_terms(token)
+            terms.extend(memo[token])
+        return terms
+
+    def _rank(self, terms, max_results):
+        """Rank documents for resolved query terms"""
+        # Only visit documents that contain each query term
+        query_postings = [(self.postings[tid], self.precomputed[tid], weight) for tid, weight in terms]
+        k = self.N if max_results is None else max_results
+        return _score_kernel(query_postings, self.N, k)
+
+    def score(self, query, max_results=None):
+        """Score all documents against query, return the top max_results (all if None)"""
+        return self._rank(self._query_terms(query), max_results)
+
+    def score_batch(self, queries, max_results=None):
+        """Score several queries, one ranking per query as returned by score().
+        Tokens shared between queries are resolved against the vocabulary once"""
+        memo = {}
+        return [self._rank(self._query_terms(query, memo), max_results) for query in queries]
 
 
 # ============ SEARCH FUNCTIONS ============
 def _load_csv(filepath):
-    """Load CSV and return list of dicts"""
+    """Load CSV column-wise, return ({column: tuple of cells}, row count)"""
     with open(filepath, 'r', encoding='utf-8') as f:
-        return list(csv.DictReader(f))
+        reader = csv.reader(f)
+        header = next(reader, [])
+        width = len(header)
+        # Skip blank lines and pad short rows with None, as csv.DictReader does
+        rows = [row + [None] * (width - len(row)) for row in reader if row]
+    return dict(zip(header, zip(*rows) if rows else [()] * width)), len(rows)
 
 
-def _search_csv(filepath, search_cols, output_cols, query, max_results):
-    """Core search function using BM25"""
-    if not filepath.exists():
-        return []
-
-    data = _load_csv(filepath)
+@lru_cache(maxsize=32)
+def _load_index(filepath, mtime_ns, search_cols):
+    """Load and index a CSV; mtime_ns is part of the cache key only"""
+    columns, n_rows = _load_csv(filepath)
 
-    # Build documents from search columns
-    documents = [" ".join(str(row.get(col, "")) for col in search_cols) for row in data]
+    # Build documents from search columns, walking the columns in parallel
+    search_values = [columns.get(col, ("",) * n_rows) for col in search_cols]
+    documents = [" ".join(map(str, cells)) for cells in zip(*search_values)]
 
-    # BM25 search
     bm25 = BM25()
     bm25.fit(documents)
-    ranked = bm25.score(query)
+    return columns, bm25
+
+
+def _get_index(filepath, search_cols):
+    """Return (columns, bm25) for a CSV, rebuilding only when the file changes"""
+    return _load_index(filepath, filepath.stat().st_mtime_ns, tuple(search_cols))
+
 
-    # Get top results with score > 0
+def _stack_config(stack):
+    """Full search config (file + shared stack columns) for a stack"""
+    return {**_STACK_COLS, **STACK_CONFIG[stack]}
+
+
+def warm_all():
+    """Build indexes for every domain and stack up front (for long-running processes)"""
+    configs = list(CSV_CONFIG.values()) + [_stack_config(stack) for stack in STACK_CONFIG]
+    for config in configs:
+        filepath = DATA_DIR / config["file"]
+        if filepath.exists():
+            _get_index(filepath, config["search_cols"])
+
+
+def _search_csv(filepath, config, query, max_results):
+    """Core search function using BM25, shared by domain and stack search.
+    Callers resolve filepath from config and check that it exists"""
+    columns, bm25 = _get_index(filepath, config["search_cols"])
+    ranked = bm25.score(query, max_results)
+
+    # Get top results with score > 0; only these rows become dicts
+    out = [(col, columns[col]) for col in config["output_cols"] if col in columns]
     results = []
-    for idx, score in ranked[:max_results]:
+    for idx, score in ranked:
         if score > 0:
-            row = data[idx]
-            results.append({col: row.get(col, "") for col in output_cols if col in row})
+            results.append({col: values[idx] for col, values in out})
 
     return results
 
 
+_DOMAIN_KEYWORDS = {
+    "color": ["color", "palette", "hex", "#", "rgb"],
+    "chart": ["chart", "graph", "visualization", "trend", "bar", "pie", "scatter", "heatmap", "funnel"],
+    "landing": ["landing", "page", "cta", "conversion", "hero", "testimonial", "pricing", "section"],
+    "product": ["saas", "ecommerce", "e-commerce", "fintech", "healthcare", "gaming", "portfolio", "crypto", "dashboard"],
+    "prompt": ["prompt", "css", "implementation", "variable", "checklist", "tailwind"],
+    "style": ["style", "design", "ui", "minimalism", "glassmorphism", "neumorphism", "brutalism", "dark mode", "flat", "aurora"],
+    "ux": ["ux", "usability", "accessibility", "wcag", "touch", "scroll", "animation", "keyboard", "navigation", "mobile"],
+    "typography": ["font", "typography", "heading", "serif", "sans"]
+}
+
+# A query that is only a hex color (#fff, #6366F1, #6366F1CC) goes to the color domain
+_HEX_COLOR_RE = re.compile(r'#(?:[0-9a-f]{8}|[0-9a-f]{6}|[0-9a-f]{3,4})')
+
+
 def detect_domain(query):
     """Auto-detect the most relevant domain from query"""
     query_lower = query.lower()
+    if _HEX_COLOR_RE.fullmatch(query_lower.strip()):
+        return "color"
 
-    domain_keywords = {
-        "color": ["color", "palette", "hex", "#", "rgb"],
-        "chart": ["chart", "graph", "visualization", "trend", "bar", "pie", "scatter", "heatmap", "funnel"],
-        "landing": ["landing", "page", "cta", "conversion", "hero", "testimonial", "pricing", "section"],
-        "product": ["saas", "ecommerce", "e-commerce", "fintech", "healthcare", "gaming", "portfolio", "crypto", "dashboard"],
-        "prompt": ["prompt", "css", "implementation", "variable", "checklist", "tailwind"],
-        "style": ["style", "design", "ui", "minimalism", "glassmorphism", "neumorphism", "brutalism", "dark mode", "flat", "aurora"],
-        "ux": ["ux", "usability", "accessibility", "wcag", "touch", "scroll", "animation", "keyboard", "navigation", "mobile"],
-        "typography": ["font", "typography", "heading", "serif", "sans"]
-    }
-
-    scores = {domain: sum(1 for kw in keywords if kw in query_lower) for domain, keywords in domain_keywords.items()}
+    scores = {domain: sum(1 for kw in keywords if kw in query_lower) for domain, keywords in _DOMAIN_KEYWORDS.items()}
     best = max(scores, key=scores.get)
     return best if scores[best] > 0 else "style"
 
@@ -205,7 +312,7 @@ def search(query, domain=None, max_results=MAX_RESULTS):
     if not filepath.exists():
         return {"error": f"File not found: {filepath}", "domain": domain}
 
-    results = _search_csv(filepath, config["search_cols"], config["output_cols"], query, max_results)
+    results = _search_csv(filepath, config, query, max_results)
 
     return {
         "domain": domain,
@@ -221,18 +328,19 @@ def search_stack(query, stack, max_results=MAX_RESULTS):
     if stack not in STACK_CONFIG:
         return {"error": f"Unknown stack: {stack}. Available: {', '.join(AVAILABLE_STACKS)}"}
 
-    filepath = DATA_DIR / STACK_CONFIG[stack]["file"]
+    config = _stack_config(stack)
+    filepath = DATA_DIR / config["file"]
 
     if not filepath.exists():
         return {"error": f"Stack file not found: {filepath}", "stack": stack}
 
-    results = _search_csv(filepath, _STACK_COLS["search_cols"], _STACK_COLS["output_cols"], query, max_results)
+    results = _search_csv(filepath, config, query, max_results)
 
     return {
         "domain": "stack",
         "stack": stack,
         "query": query,
-        "file": STACK_CONFIG[stack]["file"],
+        "file": config["file"],
         "count": len(results),
         "results": results
     }